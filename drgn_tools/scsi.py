@@ -6,20 +6,26 @@
 """
 import argparse
 import enum
+import sys
+from typing import Dict
 from typing import Iterator
+from typing import Optional
 
 from drgn import cast
 from drgn import container_of
 from drgn import FaultError
 from drgn import Object
+from drgn import offsetof
 from drgn import Program
 from drgn import sizeof
+from drgn import TypeKind
+from drgn.helpers.linux.block import for_each_disk
+from drgn.helpers.linux.list import list_for_each
 from drgn.helpers.linux.list import list_for_each_entry
 
 from drgn_tools.block import for_each_mq_pending_request
 from drgn_tools.block import for_each_sq_pending_request
 from drgn_tools.block import is_mq
-from drgn_tools.block import request_target
 from drgn_tools.corelens import CorelensModule
 from drgn_tools.device import class_to_subsys
 from drgn_tools.module import ensure_debuginfo
@@ -52,35 +58,52 @@ def for_each_scsi_host(prog: Program) -> Iterator[Object]:
     subsys_p = class_to_subsys(prog["shost_class"].address_of_())
     devices = subsys_p.klist_devices.k_list.address_of_()
 
+    # The offsets are fixed for a given kernel, so compute them up front and
+    # get from each list node to its host with plain integer arithmetic.
+    shost_type = prog.type("struct Scsi_Host *")
+    shost_dev_off = offsetof(prog.type("struct Scsi_Host"), "shost_dev")
     if class_in_private:
-        for device_private in list_for_each_entry(
-            "struct device_private", devices, "knode_class.n_node"
-        ):
-            dev = device_private.device
-            yield container_of(dev, "struct Scsi_Host", "shost_dev")
+        priv_type = prog.type("struct device_private *")
+        node_off = offsetof(
+            prog.type("struct device_private"), "knode_class.n_node"
+        )
+        for node in list_for_each(devices):
+            priv = Object(prog, priv_type, value=node.value_() - node_off)
+            dev = priv.device.value_()
+            yield Object(prog, shost_type, value=dev - shost_dev_off)
     else:
-        for dev in list_for_each_entry(
-            "struct device", devices, "knode_class.n_node"
-        ):
-            yield container_of(dev, "struct Scsi_Host", "shost_dev")
+        node_off = offsetof(prog.type("struct device"), "knode_class.n_node")
+        for node in list_for_each(devices):
+            dev = node.value_() - node_off
+            yield Object(prog, shost_type, value=dev - shost_dev_off)
+
+
+def _cstr(obj: Object) -> str:
+    """
+    Decode a short ASCII C string, such as a module, vendor or disk name.
+
+    The same handful of names repeat across every host and device, so the
+    result is interned to share a single copy of each.
+    """
+    return sys.intern(obj.string_().decode("ascii", "replace"))
 
 
 def host_module_name(shost: Object) -> str:
     """
     Fetch the module name associated with the scsi host.
 
-    :param shost: ``struct Scsi_Host *``
+    :param shost: ``struct Scsi_Host *`` or ``struct Scsi_Host``
     :returns: the module name string.
     """
     try:
-        name = shost.hostt.module.name.string_().decode()
+        name = _cstr(shost.hostt.module.name)
     except FaultError:
         name = "unknown"
     return name
 
 
 def scsi_host(prog: Program, disk: Object) -> Object:
-    diskname = disk.disk_name.string_().decode()
+    diskname = _cstr(disk.disk_name)
     if not diskname.startswith("sd"):
         return None
     q = disk.queue
@@ -118,25 +141,46 @@ def for_each_scsi_target(shost: Object) -> Iterator[Object]:
         yield scsi_target
 
 
-def scsi_device_name(sdev: Object) -> str:
+def scsi_device_name(
+    sdev: Object, gendisk_map: Optional[Dict[int, Object]] = None
+) -> str:
     """
     Get the device name associated with scsi_device.
 
     :param sdev: ``struct scsi_device *``
+    :param gendisk_map: optional result of :func:`load_gendisk`, used to
+        find the disk without walking the kobject hierarchy
     :returns: ``str``
     """
     rq = sdev.request_queue
+    if gendisk_map is not None:
+        disk = gendisk_map.get(rq.value_())
+        if disk is not None:
+            return _cstr(disk.disk_name)
     if has_member(rq, "mq_kobj"):
         # uek5 thru uek8 has mq_obj with upstream commit id 320ae51fee
         dev = container_of(rq.mq_kobj.parent, "struct device", "kobj")
     if has_member(rq, "kobj"):
         dev = container_of(rq.kobj.parent, "struct device", "kobj")
     try:
-        return dev.kobj.name.string_().decode()
+        return _cstr(dev.kobj.name)
     except FaultError:
         return ""
 
 
+def load_gendisk(prog: Program) -> Dict[int, Object]:
+    """
+    Map each request queue to the disk which owns it.
+
+    :returns: a dict from ``struct request_queue *`` address to
+        ``struct gendisk *``
+    """
+    gendisk_map = {}
+    for disk in for_each_disk(prog):
+        gendisk_map[disk.queue.value_()] = disk
+    return gendisk_map
+
+
 def for_each_scsi_cmnd(prog: Program, scsi_device: Object) -> Iterator[Object]:
     """
     Iterates thru all scsi commands for a given SCSI device.
@@ -145,12 +189,13 @@ def for_each_scsi_cmnd(prog: Program, scsi_device: Object) -> Iterator[Object]:
     :returns: an iterator of ``struct scsi_cmnd *``
     """
     q = scsi_device.request_queue
+    scmnd_type = prog.type("struct scsi_cmnd *")
     if is_mq(q):
-        for scmnd in for_each_scsi_cmd_mq(prog, scsi_device):
-            yield scmnd
+        scmnds = for_each_scsi_cmd_mq(prog, scsi_device)
     else:
-        for scmnd in for_each_scsi_cmd_sq(prog, scsi_device):
-            yield scmnd
+        scmnds = for_each_scsi_cmd_sq(prog, scsi_device)
+    for scmnd in scmnds:
+        yield Object(prog, scmnd_type, value=scmnd)
 
 
 def rq_to_scmnd(prog: Program, rq: Object) -> Object:
@@ -164,24 +209,25 @@ def rq_to_scmnd(prog: Program, rq: Object) -> Object:
     return Object(prog, "struct scsi_cmnd *", value=scmnd)
 
 
-def for_each_scsi_cmd_sq(prog: Program, dev: Object) -> Iterator[Object]:
+def for_each_scsi_cmd_sq(prog: Program, dev: Object) -> Iterator[int]:
     """
     Iterates thru all SCSI commands from the block layer pending requests.
 
     :param dev: ``strcut scsi_device *``
-    :returns: an iterator of ``struct scsi_cmnd *``
+    :returns: an iterator of ``struct scsi_cmnd *`` addresses
     """
     q = dev.request_queue
+    req_size = sizeof(prog.type("struct request"))
     for rq in for_each_sq_pending_request(q):
-        yield rq_to_scmnd(prog, rq)
+        yield rq.value_() + req_size
 
 
-def for_each_scsi_cmd_mq(prog: Program, dev: Object) -> Iterator[Object]:
+def for_each_scsi_cmd_mq(prog: Program, dev: Object) -> Iterator[int]:
     """
     Iterates thru all SCSI commands in all multi hardware queue.
 
     :param dev: ``strcut scsi_device *``
-    :returns: an iterator of ``struct scsi_cmnd *``
+    :returns: an iterator of ``struct scsi_cmnd *`` addresses
     """
     try:
         BLK_MQ_F_TAG_SHARED = prog.constant("BLK_MQ_F_TAG_SHARED")
@@ -189,13 +235,15 @@ def for_each_scsi_cmd_mq(prog: Program, dev: Object) -> Iterator[Object]:
         BLK_MQ_F_TAG_SHARED = prog.constant("BLK_MQ_F_TAG_QUEUE_SHARED")
 
     q = dev.request_queue
-    disk = dev.request_queue.disk
+    q_addr = q.value_()
+    req_size = sizeof(prog.type("struct request"))
     for hwq, rq in for_each_mq_pending_request(q):
-        if (hwq.flags & BLK_MQ_F_TAG_SHARED) != 0 and request_target(
-            rq
-        ).value_() != disk.value_():
+        # A shared tag set also holds requests of the other devices on the
+        # host. Compare the owning queue directly: request_target() may need
+        # to search every disk in the system to answer the same question.
+        if (hwq.flags & BLK_MQ_F_TAG_SHARED) != 0 and rq.q.value_() != q_addr:
             continue
-        yield rq_to_scmnd(prog, rq)
+        yield rq.value_() + req_size
 
 
 def scsi_id(scsi_dev: Object) -> str:
@@ -207,18 +255,11 @@ def scsi_id(scsi_dev: Object) -> str:
     """
     if not scsi_dev:
         return "<unknown>"
-    hctl = (
-        "["
-        + str(scsi_dev.host.host_no.value_())
-        + ":"
-        + str(scsi_dev.channel.value_())
-        + ":"
-        + str(scsi_dev.id.value_())
-        + ":"
-        + str(scsi_dev.lun.value_())
-        + "]"
-    )
-    return hctl
+    h = scsi_dev.host.host_no.value_()
+    c = scsi_dev.channel.value_()
+    t = scsi_dev.id.value_()
+    lun = scsi_dev.lun.value_()
+    return f"[{h}:{c}:{t}:{lun}]"
 
 
 def print_scsi_hosts(prog: Program, verbose: bool = False) -> None:
@@ -244,8 +285,12 @@ def print_scsi_hosts(prog: Program, verbose: bool = False) -> None:
     )
 
     for shost in for_each_scsi_host(prog):
-        if shost.hostt.module.version:
-            modver = shost.hostt.module.version.string_().decode()
+        # Read the whole structure once, so that the fields below come from
+        # a local copy rather than a separate memory read each.
+        host = shost[0].read_()
+        name = host_module_name(host)
+        if host.hostt.module.version:
+            modver = host.hostt.module.version.string_().decode()
         else:
             modver = "n/a"
 
@@ -253,37 +298,37 @@ def print_scsi_hosts(prog: Program, verbose: bool = False) -> None:
         Since 6eb045e092ef ("scsi: core: avoid host-wide host_busy counter for scsi_mq"),
         host_busy is no longer a member of struct Scsi_Host.
         """
-        if has_member(shost, "host_busy"):
-            host_busy = shost.host_busy.counter.value_()
+        if has_member(host, "host_busy"):
+            host_busy = host.host_busy.counter.value_()
         else:
             host_busy = "n/a"
 
-        if has_member(shost, "eh_deadline"):
-            eh_deadline = shost.eh_deadline.value_()
+        if has_member(host, "eh_deadline"):
+            eh_deadline = host.eh_deadline.value_()
         else:
             eh_deadline = "n/a"
 
         table.row(
             hex(shost.value_()),
-            f"host{shost.host_no.value_():>}",
-            host_module_name(shost),
+            f"host{host.host_no.value_():>}",
+            name,
             modver,
             host_busy,
-            shost.host_blocked.counter.value_(),
-            shost.host_failed.value_(),
-            shost.shost_state.format_(type_name=False),
+            host.host_blocked.counter.value_(),
+            host.host_failed.value_(),
+            host.shost_state.format_(type_name=False),
             eh_deadline,
-            shost.cmd_per_lun.value_(),
-            shost.nr_hw_queues.value_(),
+            host.cmd_per_lun.value_(),
+            host.nr_hw_queues.value_(),
         )
         if verbose:
             print("-" * 120)
             try:
-                if host_module_name(shost) == "qla2xxx":
+                if name == "qla2xxx":
                     print_qla2xxx_shost_info(prog, shost)
-                elif host_module_name(shost) == "lpfc":
+                elif name == "lpfc":
                     print_lpfc_shost_info(prog, shost)
-                elif host_module_name(shost) == "megaraid_sas":
+                elif name == "megaraid_sas":
                     print_megaraid_shost_info(prog, shost)
             except ValueError:
                 print(
@@ -523,15 +568,21 @@ def print_qla2xxx_shost_info(prog: Program, shost: Object) -> None:
     print("-" * 120)
 
 
-def print_shost_devs(prog: Program) -> None:
+def print_shost_devs(
+    prog: Program, gendisk_map: Optional[Dict[int, Object]] = None
+) -> None:
     """
     print all scsi devices for a Scsi_Host
+
+    :param gendisk_map: the result of :func:`load_gendisk`, if already loaded
     """
     msg = ensure_debuginfo(prog, ["sd_mod"])
     if msg:
         print(msg)
         return
 
+    if gendisk_map is None:
+        gendisk_map = load_gendisk(prog)
     for shost in for_each_scsi_host(prog):
         print_shost_header(shost)
         output = [
@@ -548,50 +599,58 @@ def print_shost_devs(prog: Program) -> None:
         ]
 
         for scsi_dev in for_each_scsi_host_device(shost):
-            vendor = scsi_dev.vendor.string_().decode()
-            devstate = str(scsi_dev.sdev_state.format_(type_name=False))
+            sdev = scsi_dev[0].read_()
+            vendor = _cstr(sdev.vendor)
+            devstate = str(sdev.sdev_state.format_(type_name=False))
 
             output.append(
                 [
-                    scsi_device_name(scsi_dev),
+                    scsi_device_name(scsi_dev, gendisk_map),
                     scsi_id(scsi_dev),
                     hex(scsi_dev),
-                    str(vendor),
+                    vendor,
                     devstate,
-                    f"{scsi_dev.iorequest_cnt.counter.value_():>7}",
-                    f"{scsi_dev.iodone_cnt.counter.value_():>7}",
-                    f"{scsi_dev.ioerr_cnt.counter.value_():>4}",
+                    f"{sdev.iorequest_cnt.counter.value_():>7}",
+                    f"{sdev.iodone_cnt.counter.value_():>7}",
+                    f"{sdev.ioerr_cnt.counter.value_():>4}",
                 ]
             )
         print_table(output)
 
 
-def print_inflight_scsi_cmnds(prog: Program) -> None:
+def print_inflight_scsi_cmnds(
+    prog: Program, gendisk_map: Optional[Dict[int, Object]] = None
+) -> None:
     """
     print all inflight SCSI commands for all SCSI devices.
+
+    :param gendisk_map: the result of :func:`load_gendisk`, if already loaded
     """
+    if gendisk_map is None:
+        gendisk_map = load_gendisk(prog)
     TotalInflight = 0
+    # These only depend on the kernel version, so look them up once rather
+    # than for every command.
+    req_size = sizeof(prog.type("struct request"))
+    cmnd_has_request = prog.type("struct scsi_cmnd").has_member("request")
+    bio_has_bi_sector = prog.type("struct bio").has_member("bi_sector")
+    # Newer kernels store the CDB inline in struct scsi_cmnd, while older ones
+    # only have a pointer to it.
+    cdb_inline = (
+        prog.type("struct scsi_cmnd").member("cmnd").type.kind
+        == TypeKind.ARRAY
+    )
+    # Snapshot jiffies so that all ages are relative to the same instant.
+    # Ages are computed as plain ints, so wrap them like unsigned long would.
+    jiffies = prog["jiffies"].value_()
+    jiffies_mask = (1 << (8 * sizeof(prog.type("unsigned long")))) - 1
     for shost in for_each_scsi_host(prog):
         for scsi_dev in for_each_scsi_host_device(shost):
-            diskname = scsi_device_name(scsi_dev)
-
             counter = 0
-            output = [
-                [
-                    "Count",
-                    "Request",
-                    "Bio",
-                    "SCSI Cmnd",
-                    "Opcode",
-                    "Length",
-                    "Age",
-                    "Sector",
-                ]
-            ]
-
             for scsi_cmnd in for_each_scsi_cmnd(prog, scsi_dev):
                 if counter == 0:
-                    vendor = scsi_dev.vendor.string_().decode()
+                    diskname = scsi_device_name(scsi_dev, gendisk_map)
+                    vendor = _cstr(scsi_dev.vendor)
                     devstate = str(
                         scsi_dev.sdev_state.format_(type_name=False)
                     )
@@ -604,56 +663,77 @@ def print_inflight_scsi_cmnds(prog: Program) -> None:
                         f" Vendor   : {vendor}    \tDevice State\t : {devstate}"
                     )
                     print("-" * 115)
+                    # Devices may have a deep queue, so print each command as
+                    # we go rather than collecting the whole table first.
+                    table = FixedTable(
+                        header=[
+                            "Count",
+                            "Request",
+                            "Bio",
+                            "SCSI Cmnd",
+                            "Opcode",
+                            "Length",
+                            "Age",
+                            "Sector",
+                        ]
+                    )
 
-                if has_member(scsi_cmnd, "request"):
-                    req = scsi_cmnd.request
+                # Read the command and its CDB in bulk, rather than making a
+                # separate memory access for each field and CDB byte.
+                cmd = scsi_cmnd[0].read_()
+                if cdb_inline:
+                    cdb = cmd.cmnd.to_bytes_()
                 else:
-                    reqp = scsi_cmnd.value_() - sizeof(
-                        prog.type("struct request")
-                    )
+                    cdb = prog.read(cmd.cmnd.value_(), 16)
+
+                if cmnd_has_request:
+                    req = cmd.request
+                else:
+                    reqp = scsi_cmnd.value_() - req_size
                     req = Object(prog, "struct request *", value=reqp)
 
                 try:
-                    opcode = Opcode(scsi_cmnd.cmnd[0].value_()).name
+                    opcode = Opcode(cdb[0]).name
                 except ValueError:
-                    opcode = str(hex(scsi_cmnd.cmnd[0].value_()))
+                    opcode = hex(cdb[0])
 
-                if scsi_cmnd.cmnd[0] == 0x2A or scsi_cmnd.cmnd[0] == 0x28:
+                if cdb[0] in (Opcode.READ_10.value, Opcode.WRITE_10.value):
                     xfer_len = (
-                        scsi_cmnd.cmnd[7] << 8 | scsi_cmnd.cmnd[8]
-                    ) * scsi_cmnd.transfersize
+                        cdb[7] << 8 | cdb[8]
+                    ) * cmd.transfersize.value_()
                 else:
                     xfer_len = 0
 
-                if req.bio:
-                    if has_member(req.bio, "bi_sector"):
-                        sector = req.bio.bi_sector
+                # Read the bio pointer once: it's needed for the NULL check
+                # as well as the output.
+                bio = req.bio.read_()
+                if bio:
+                    if bio_has_bi_sector:
+                        sector = bio.bi_sector.value_()
                     else:
-                        sector = req.bio.bi_iter.bi_sector
+                        sector = bio.bi_iter.bi_sector.value_()
                 else:
                     sector = 0
 
                 age = (
-                    prog["jiffies"] - scsi_cmnd.jiffies_at_alloc
-                ).value_() * 1000000
+                    (jiffies - cmd.jiffies_at_alloc.value_()) & jiffies_mask
+                ) * 1000000
                 counter += 1
 
-                output.append(
-                    [
-                        f"{counter:>4}",
-                        hex(req.value_()),
-                        hex(req.bio.value_()),
-                        hex(scsi_cmnd.value_()),
-                        opcode,
-                        f"{int(xfer_len):>7}",
-                        timestamp_str(age),
-                        f"{int(sector):>11}",
-                    ]
+                table.row(
+                    f"{counter:>4}",
+                    hex(req.value_()),
+                    hex(bio.value_()),
+                    hex(scsi_cmnd.value_()),
+                    opcode,
+                    f"{int(xfer_len):>7}",
+                    timestamp_str(age),
+                    f"{sector:>11}",
                 )
 
             if counter > 0:
                 TotalInflight += counter
-                print_table(output)
+                table.write()
                 print("-" * 115)
     print(f" Total inflight commands across all disks : {TotalInflight}")
     print("-" * 115)
@@ -750,10 +830,12 @@ class ScsiInfo(CorelensModule):
     def run(self, prog: Program, args: argparse.Namespace) -> None:
         if args.hosts:
             print_scsi_hosts(prog, verbose=args.verbose)
-        elif args.devices:
-            print_shost_devs(prog)
-        elif args.queue:
-            print_inflight_scsi_cmnds(prog)
+        elif args.devices or args.queue:
+            gendisk_map = load_gendisk(prog)
+            if args.devices:
+                print_shost_devs(prog, gendisk_map)
+            else:
+                print_inflight_scsi_cmnds(prog, gendisk_map)
         elif args.target:
             print_scsi_target(prog)
         else:
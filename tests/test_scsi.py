@@ -5,3 +5,11 @@ from drgn_tools import scsi
 
 def test_scsi(prog):
     scsi.print_scsi_hosts(prog)
+
+
+def test_scsi_inflight_cmnds(prog):
+    scsi.print_inflight_scsi_cmnds(prog)
+
+
+def test_scsi_devices(prog):
+    scsi.print_shost_devs(prog)